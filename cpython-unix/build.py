@@ -685,7 +685,7 @@ def python_build_info(
                 links.append({"name": libname, "system": True})
 
         if targets := info.get("required-targets"):
-            required = any(re.match(p, target_triple) for p in targets)
+            required = any(p.match(target_triple) for p in targets)
         else:
             required = False
 
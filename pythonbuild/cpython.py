@@ -2,6 +2,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import collections
+import functools
 import pathlib
 import re
 import tarfile
@@ -11,6 +13,13 @@ import yaml
 
 from pythonbuild.logging import log
 
+# The libyaml backed loader is much faster. But it is only available if PyYAML
+# was built against libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[assignment]
+
 EXTENSION_MODULE_SCHEMA = {
     "type": "object",
     "properties": {
@@ -114,22 +123,51 @@ EXTENSION_MODULES_SCHEMA = {
     },
 }
 
+# Constructing a validator is relatively expensive. So build it once and
+# reuse it for every load of the extension modules YAML.
+jsonschema.Draft7Validator.check_schema(EXTENSION_MODULES_SCHEMA)
+EXTENSION_MODULES_VALIDATOR = jsonschema.Draft7Validator(EXTENSION_MODULES_SCHEMA)
+
 
 # Packages that define tests.
-STDLIB_TEST_PACKAGES = {
-    "bsddb.test",
-    "ctypes.test",
-    "distutils.tests",
-    "email.test",
-    "idlelib.idle_test",
-    "json.tests",
-    "lib-tk.test",
-    "lib2to3.tests",
-    "sqlite3.test",
-    "test",
-    "tkinter.test",
-    "unittest.test",
-}
+STDLIB_TEST_PACKAGES = frozenset(
+    {
+        "bsddb.test",
+        "ctypes.test",
+        "distutils.tests",
+        "email.test",
+        "idlelib.idle_test",
+        "json.tests",
+        "lib-tk.test",
+        "lib2to3.tests",
+        "sqlite3.test",
+        "test",
+        "tkinter.test",
+        "unittest.test",
+    }
+)
+
+RE_VARIABLE = re.compile(rb"^[a-zA-Z_]+\s*=")
+RE_EXTENSION_MODULE = re.compile(rb"^([a-z_]+)\s.*[a-zA-Z/_-]+\.c\b")
+RE_INITTAB_ENTRY = re.compile(r'\{"([^"]+)", ([^\}\n]+)\},')
+
+
+def source_obj_path(source: str, nested: bool) -> pathlib.Path:
+    """Obtain the object file path makesetup uses for a C source file.
+
+    ``nested`` should be true for Python 3.11+, which keeps the parent
+    directories of the source in the object file path.
+    """
+    # Object files are named according to the basename: parent directories
+    # they may happen to reside in are stripped out. Plain string manipulation
+    # is much cheaper than deriving these through pathlib.
+    parent, _, basename = source.rpartition("/")
+    obj_name = basename[:-2] + ".o"
+
+    if nested and parent:
+        return pathlib.Path(f"Modules/{parent}/{obj_name}")
+    else:
+        return pathlib.Path(f"Modules/{obj_name}")
 
 
 def parse_setup_line(line: bytes, python_version: str):
@@ -148,35 +186,25 @@ def parse_setup_line(line: bytes, python_version: str):
     links = set()
     frameworks = set()
 
-    for i, word in enumerate(words):
-        # Arguments looking like C source files are converted to object files.
-        if word.endswith(b".c"):
-            # Object files are named according to the basename: parent
-            # directories they may happen to reside in are stripped out.
-            source_path = pathlib.Path(word.decode("ascii"))
-
-            # Python 3.11 changed the path of the object file.
-            if meets_python_minimum_version(python_version, "3.11") and b"/" in word:
-                obj_path = (
-                    pathlib.Path("Modules")
-                    / source_path.parent
-                    / source_path.with_suffix(".o").name
-                )
-            else:
-                obj_path = pathlib.Path("Modules") / source_path.with_suffix(".o").name
+    # Python 3.11 changed the path of the object file.
+    nested_obj_paths = meets_python_minimum_version(python_version, "3.11")
 
-            objs.add(obj_path)
+    for i, word in enumerate(words):
+        if word[:1] == b"-":
+            # Arguments looking like link libraries are converted to library
+            # dependencies.
+            if word.startswith(b"-l"):
+                links.add(word[2:].decode("ascii"))
 
-        # Arguments looking like link libraries are converted to library
-        # dependencies.
-        elif word.startswith(b"-l"):
-            links.add(word[2:].decode("ascii"))
+            elif word.startswith(b"-hidden-l"):
+                links.add(word[len("-hidden-l") :].decode("ascii"))
 
-        elif word.startswith(b"-hidden-l"):
-            links.add(word[len("-hidden-l") :].decode("ascii"))
+            elif word == b"-framework":
+                frameworks.add(words[i + 1].decode("ascii"))
 
-        elif word == b"-framework":
-            frameworks.add(words[i + 1].decode("ascii"))
+        # Arguments looking like C source files are converted to object files.
+        elif word.endswith(b".c"):
+            objs.add(source_obj_path(word.decode("ascii"), nested_obj_paths))
 
     return {
         "extension": extension,
@@ -203,24 +231,40 @@ def link_for_target(lib: str, target_triple: str) -> str:
         return f"-l{lib}"
 
 
-def meets_python_minimum_version(got: str, wanted: str) -> bool:
-    parts = got.split(".")
-    got_major, got_minor = int(parts[0]), int(parts[1])
+@functools.lru_cache(maxsize=None)
+def python_version_tuple(version: str) -> tuple[int, int]:
+    """Obtain the (major, minor) components of a Python version string."""
+    parts = version.split(".")
+
+    return int(parts[0]), int(parts[1])
 
-    parts = wanted.split(".")
-    wanted_major, wanted_minor = int(parts[0]), int(parts[1])
 
-    return (got_major, got_minor) >= (wanted_major, wanted_minor)
+def meets_python_minimum_version(got: str, wanted: str) -> bool:
+    return python_version_tuple(got) >= python_version_tuple(wanted)
 
 
 def meets_python_maximum_version(got: str, wanted: str) -> bool:
-    parts = got.split(".")
-    got_major, got_minor = int(parts[0]), int(parts[1])
+    return python_version_tuple(got) <= python_version_tuple(wanted)
+
+
+def python_version_in_range(entry, version: tuple[int, int]) -> bool:
+    """Whether a parsed Python version satisfies an entry's version bounds."""
+    return (
+        python_version_tuple(entry.get("minimum-python-version", "1.0"))
+        <= version
+        <= python_version_tuple(entry.get("maximum-python-version", "100.0"))
+    )
 
-    parts = wanted.split(".")
-    wanted_major, wanted_minor = int(parts[0]), int(parts[1])
 
-    return (got_major, got_minor) <= (wanted_major, wanted_minor)
+def conditional_entry_matches(
+    entry, version: tuple[int, int], target_triple: str
+) -> bool:
+    """Whether a conditional entry in the extension modules YAML applies."""
+    if targets := entry.get("targets"):
+        if not any(p.match(target_triple) for p in targets):
+            return False
+
+    return python_version_in_range(entry, version)
 
 
 def derive_setup_local(
@@ -241,26 +285,27 @@ def derive_setup_local(
     setup_enabled_wanted = set()
     config_c_only_wanted = set()
 
+    # Version bounds are compared against the parsed target version.
+    version = python_version_tuple(python_version)
+
+    # Both passes over our extension modules below walk them in name order.
+    sorted_names = sorted(extension_modules)
+
     # Collect metadata about our extension modules as they relate to this
     # Python target.
-    for name, info in sorted(extension_modules.items()):
-        python_min_match = meets_python_minimum_version(
-            python_version, info.get("minimum-python-version", "1.0")
-        )
-        python_max_match = meets_python_maximum_version(
-            python_version, info.get("maximum-python-version", "100.0")
-        )
+    for name in sorted_names:
+        info = extension_modules[name]
 
         if info.get("build-mode") not in (None, "shared", "static"):
             raise Exception("unsupported build-mode for extension module %s" % name)
 
-        if not (python_min_match and python_max_match):
+        if not python_version_in_range(info, version):
             log(f"ignoring extension module {name} because Python version incompatible")
             ignored.add(name)
             continue
 
         if targets := info.get("disabled-targets"):
-            if any(re.match(p, target_triple) for p in targets):
+            if any(p.match(target_triple) for p in targets):
                 log(
                     "disabling extension module %s because disabled for this target triple"
                     % name
@@ -271,15 +316,8 @@ def derive_setup_local(
             setup_enabled_wanted.add(name)
 
         for entry in info.get("setup-enabled-conditional", []):
-            python_min_match_setup = meets_python_minimum_version(
-                python_version, entry.get("minimum-python-version", "1.0")
-            )
-            python_max_match_setup = meets_python_maximum_version(
-                python_version, entry.get("maximum-python-version", "100.0")
-            )
-
-            if entry.get("enabled", False) and (
-                python_min_match_setup and python_max_match_setup
+            if entry.get("enabled", False) and conditional_entry_matches(
+                entry, version, target_triple
             ):
                 setup_enabled_wanted.add(name)
 
@@ -288,27 +326,41 @@ def derive_setup_local(
 
     # Parse more files in the distribution for their metadata.
 
-    with tarfile.open(str(cpython_source_archive)) as tf:
-        ifh = tf.extractfile("Python-%s/Modules/Setup" % python_version)
-        setup_lines = ifh.readlines()
+    setup_path = f"Python-{python_version}/Modules/Setup"
+    setup_bootstrap_in_path = f"Python-{python_version}/Modules/Setup.bootstrap.in"
+    config_c_in_path = f"Python-{python_version}/Modules/config.c.in"
 
-        try:
-            ifh = tf.extractfile(f"Python-{python_version}/Modules/Setup.bootstrap.in")
-            setup_bootstrap_in = ifh.readlines()
-        except KeyError:
-            setup_bootstrap_in = []
+    source_files = {
+        setup_path: None,
+        setup_bootstrap_in_path: None,
+        config_c_in_path: None,
+    }
+
+    # We only need a handful of files from the source archive. So stream
+    # through it once instead of having tarfile index every member.
+    with tarfile.open(str(cpython_source_archive), "r|*") as tf:
+        for member in tf:
+            if member.name not in source_files:
+                continue
 
-        ifh = tf.extractfile("Python-%s/Modules/config.c.in" % python_version)
-        config_c_in = ifh.read()
+            source_files[member.name] = tf.extractfile(member).read()
+
+            if all(data is not None for data in source_files.values()):
+                break
+
+    for path in (setup_path, config_c_in_path):
+        if source_files[path] is None:
+            raise Exception(f"{path} not found in {cpython_source_archive}")
+
+    setup_lines = source_files[setup_path].splitlines()
+    setup_bootstrap_in = (source_files[setup_bootstrap_in_path] or b"").splitlines()
+    config_c_in = source_files[config_c_in_path]
 
     dist_modules = set()
     setup_enabled_actual = set()
     setup_enabled_lines = {}
     section = "static"
 
-    RE_VARIABLE = re.compile(rb"^[a-zA-Z_]+\s*=")
-    RE_EXTENSION_MODULE = re.compile(rb"^([a-z_]+)\s.*[a-zA-Z/_-]+\.c\b")
-
     # Setup.bootstrap.in has a simple format.
     for line in setup_bootstrap_in:
         if b"#" in line:
@@ -343,15 +395,18 @@ def derive_setup_local(
         if RE_VARIABLE.match(line):
             continue
 
-        # Look for extension syntax before and after comment.
-        for i, part in enumerate(line.split(b"#")):
-            if m := RE_EXTENSION_MODULE.match(part):
-                dist_modules.add(m.group(1).decode("ascii"))
+        # Look for extension syntax before and after comment. Only extensions
+        # before the comment are enabled.
+        code, sep, comment = line.partition(b"#")
 
-                if i == 0:
-                    setup_enabled_actual.add(m.group(1).decode("ascii"))
-
-                break
+        if m := RE_EXTENSION_MODULE.match(code):
+            dist_modules.add(m.group(1).decode("ascii"))
+            setup_enabled_actual.add(m.group(1).decode("ascii"))
+        elif sep:
+            for part in comment.split(b"#"):
+                if m := RE_EXTENSION_MODULE.match(part):
+                    dist_modules.add(m.group(1).decode("ascii"))
+                    break
 
         # Now look for enabled extensions and stash away the line.
 
@@ -373,8 +428,7 @@ def derive_setup_local(
 
     config_c_extensions = parse_config_c(config_c_in.decode("utf-8"))
 
-    for extension in sorted(config_c_extensions):
-        dist_modules.add(extension)
+    dist_modules |= config_c_extensions.keys()
 
     # With ours and theirs extension module metadata collections, compare and
     # make sure our metadata is comprehensive. This isn't strictly necessary.
@@ -382,7 +436,7 @@ def derive_setup_local(
     # out of sync with the distribution. This has historically caused several
     # subtle and hard-to-diagnose bugs, which is why we do it.
 
-    missing = dist_modules - set(extension_modules.keys())
+    missing = dist_modules - extension_modules.keys()
 
     if missing:
         raise Exception(
@@ -403,13 +457,13 @@ def derive_setup_local(
             % ", ".join(sorted(extra))
         )
 
-    if missing := set(config_c_extensions) - config_c_only_wanted:
+    if missing := config_c_extensions.keys() - config_c_only_wanted:
         raise Exception(
             "config.c.in extensions missing YAML config-c-only annotation: %s"
             % ", ".join(sorted(missing))
         )
 
-    if extra := config_c_only_wanted - set(config_c_extensions):
+    if extra := config_c_only_wanted - config_c_extensions.keys():
         raise Exception(
             "YAML config-c-only extensions not present in config.c.in: %s"
             % ", ".join(sorted(extra))
@@ -420,10 +474,13 @@ def derive_setup_local(
     # agrees fully with the distribution's knowledge of extensions. So we can
     # treat our metadata as canonical.
 
-    RE_DEFINE = re.compile(rb"-D[^=]+=[^\s]+")
-
     # Translate our YAML metadata into Setup lines.
 
+    is_apple = "-apple-" in target_triple
+
+    # Python 3.11 changed the path of the object file.
+    nested_obj_paths = version >= (3, 11)
+
     section_lines = {
         "disabled": [],
         "shared": [],
@@ -434,11 +491,13 @@ def derive_setup_local(
     # to be no easy way to define e.g. -Dfoo=bar in Setup.local. We hack
     # around this by producing a Makefile supplement that overrides the build
     # rules for certain targets to include these missing values.
-    extra_cflags = {}
+    extra_cflags = collections.defaultdict(list)
 
     enabled_extensions = {}
 
-    for name, info in sorted(extension_modules.items()):
+    for name in sorted_names:
+        info = extension_modules[name]
+
         if name in ignored:
             continue
 
@@ -492,126 +551,77 @@ def derive_setup_local(
 
         log(f"extension {name} being configured via YAML metadata")
 
-        line = name
-
-        for source in info.get("sources", []):
-            line += " %s" % source
+        sources = list(info.get("sources", []))
 
         for entry in info.get("sources-conditional", []):
-            if targets := entry.get("targets", []):
-                target_match = any(re.match(p, target_triple) for p in targets)
-            else:
-                target_match = True
-
-            python_min_match = meets_python_minimum_version(
-                python_version, entry.get("minimum-python-version", "1.0")
-            )
-            python_max_match = meets_python_maximum_version(
-                python_version, entry.get("maximum-python-version", "100.0")
-            )
-
-            if target_match and (python_min_match and python_max_match):
+            if conditional_entry_matches(entry, version, target_triple):
                 if source := entry.get("source"):
-                    line += f" {source}"
-                for source in entry.get("sources", []):
-                    line += f" {source}"
+                    sources.append(source)
+                sources.extend(entry.get("sources", []))
 
-        for define in info.get("defines", []):
-            line += f" -D{define}"
+        defines = list(info.get("defines", []))
 
         for entry in info.get("defines-conditional", []):
-            if targets := entry.get("targets", []):
-                target_match = any(re.match(p, target_triple) for p in targets)
-            else:
-                target_match = True
-
-            python_min_match = meets_python_minimum_version(
-                python_version, entry.get("minimum-python-version", "1.0")
-            )
-            python_max_match = meets_python_maximum_version(
-                python_version, entry.get("maximum-python-version", "100.0")
-            )
+            if conditional_entry_matches(entry, version, target_triple):
+                defines.append(entry["define"])
 
-            if target_match and (python_min_match and python_max_match):
-                line += f" -D{entry['define']}"
+        words = [name, *sources]
 
-        for path in info.get("includes", []):
-            line += f" -I{path}"
+        # makesetup parses lines with = as extra config options. There appears
+        # to be no easy way to define e.g. -Dfoo=bar in Setup.local. We hack
+        # around this by moving these defines to a Makefile supplement that
+        # overrides variables for the object files of this extension.
+        value_defines = []
 
-        for entry in info.get("includes-conditional", []):
-            if targets := entry.get("targets", []):
-                target_match = any(re.match(p, target_triple) for p in targets)
+        for define in defines:
+            if "=" in define:
+                value_defines.append(f"-D{define}".encode("ascii"))
             else:
-                target_match = True
+                words.append(f"-D{define}")
 
-            python_min_match = meets_python_minimum_version(
-                python_version, entry.get("minimum-python-version", "1.0")
-            )
-            python_max_match = meets_python_maximum_version(
-                python_version, entry.get("maximum-python-version", "100.0")
-            )
+        for path in info.get("includes", []):
+            words.append(f"-I{path}")
 
-            if target_match and (python_min_match and python_max_match):
+        for entry in info.get("includes-conditional", []):
+            if conditional_entry_matches(entry, version, target_triple):
                 # TODO: Change to `include` and drop support for `path`
                 if include := entry.get("path"):
-                    line += f" -I{include}"
+                    words.append(f"-I{include}")
                 for include in entry.get("includes", []):
-                    line += f" -I{include}"
-
-        for path in info.get("includes-deps", []):
-            # Includes are added to global search path.
-            if "-apple-" in target_triple:
-                continue
+                    words.append(f"-I{include}")
 
-            line += f" -I/tools/deps/{path}"
+        # Includes are added to global search path on Apple.
+        if not is_apple:
+            for path in info.get("includes-deps", []):
+                words.append(f"-I/tools/deps/{path}")
 
         for lib in info.get("links", []):
-            line += " %s" % link_for_target(lib, target_triple)
+            words.append(link_for_target(lib, target_triple))
 
         for entry in info.get("links-conditional", []):
-            if targets := entry.get("targets", []):
-                target_match = any(re.match(p, target_triple) for p in targets)
-            else:
-                target_match = True
-
-            python_min_match = meets_python_minimum_version(
-                python_version, entry.get("minimum-python-version", "1.0")
-            )
-            python_max_match = meets_python_maximum_version(
-                python_version, entry.get("maximum-python-version", "100.0")
-            )
-
-            if target_match and (python_min_match and python_max_match):
-                line += " %s" % link_for_target(entry["name"], target_triple)
+            if conditional_entry_matches(entry, version, target_triple):
+                words.append(link_for_target(entry["name"], target_triple))
 
-        if "-apple-" in target_triple:
+        if is_apple:
             for framework in info.get("frameworks", []):
-                line += f" -framework {framework}"
+                words.append(f"-framework {framework}")
 
         for entry in info.get("linker-args", []):
-            if any(re.match(p, target_triple) for p in entry["targets"]):
+            if any(p.match(target_triple) for p in entry["targets"]):
                 for arg in entry["args"]:
-                    line += f" -Xlinker {arg}"
+                    words.append(f"-Xlinker {arg}")
 
-        line = line.encode("ascii")
+        if value_defines:
+            obj_paths = {
+                bytes(source_obj_path(source, nested_obj_paths))
+                for source in sources
+                if source.endswith(".c")
+            }
 
-        # This extra parse is a holder from older code and could likely be
-        # factored away.
-        parsed = parse_setup_line(line, python_version=python_version)
+            for obj_path in obj_paths:
+                extra_cflags[obj_path].extend(value_defines)
 
-        if not parsed:
-            raise Exception("we should always parse a setup line we generated")
-
-        # makesetup parses lines with = as extra config options. There appears
-        # to be no easy way to define e.g. -Dfoo=bar in Setup.local. We hack
-        # around this by detecting the syntax we'd like to support and move the
-        # variable defines to a Makefile supplement that overrides variables for
-        # specific targets.
-        for m in RE_DEFINE.finditer(parsed["line"]):
-            for obj_path in sorted(parsed["posix_obj_paths"]):
-                extra_cflags.setdefault(bytes(obj_path), []).append(m.group(0))
-
-        line = RE_DEFINE.sub(b"", line)
+        line = " ".join(words).encode("ascii")
 
         if b"=" in line:
             raise Exception(
@@ -633,12 +643,10 @@ def derive_setup_local(
 
     dest_lines.append(b"")
 
-    make_lines = []
-
-    for target in sorted(extra_cflags):
-        make_lines.append(
-            b"%s: PY_STDMODULE_CFLAGS += %s" % (target, b" ".join(extra_cflags[target]))
-        )
+    make_lines = [
+        b"%s: PY_STDMODULE_CFLAGS += %s" % (target, b" ".join(defines))
+        for target, defines in sorted(extra_cflags.items())
+    ]
 
     return {
         "extensions": enabled_extensions,
@@ -647,9 +655,6 @@ def derive_setup_local(
     }
 
 
-RE_INITTAB_ENTRY = re.compile('\{"([^"]+)", ([^\}]+)\},')
-
-
 def parse_config_c(s: str):
     """Parse the contents of a config.c file.
 
@@ -660,33 +665,49 @@ def parse_config_c(s: str):
     # Some config.c files have #ifdef. We don't care about those because
     # in all cases the condition is true.
 
-    extensions = {}
-
-    seen_inittab = False
-
-    for line in s.splitlines():
-        if line.startswith("struct _inittab"):
-            seen_inittab = True
-
-        if not seen_inittab:
-            continue
+    # Only the _inittab definition is interesting. Find the line it starts on
+    # and stop at the line holding the sentinel entry.
+    if s.startswith("struct _inittab"):
+        start = 0
+    else:
+        start = s.find("\nstruct _inittab")
 
-        if "/* Sentinel */" in line:
-            break
+        if start == -1:
+            return {}
 
-        m = RE_INITTAB_ENTRY.search(line)
+    end = s.find("/* Sentinel */", start)
 
-        if m:
-            extensions[m.group(1)] = m.group(2)
+    if end == -1:
+        end = len(s)
+    else:
+        end = max(s.rfind("\n", start, end), start)
 
-    return extensions
+    return {m.group(1): m.group(2) for m in RE_INITTAB_ENTRY.finditer(s, start, end)}
 
 
 def extension_modules_config(yaml_path: pathlib.Path):
     """Loads the extension-modules.yml file."""
     with yaml_path.open("r", encoding="utf-8") as fh:
-        data = yaml.load(fh, Loader=yaml.SafeLoader)
-
-    jsonschema.validate(data, EXTENSION_MODULES_SCHEMA)
+        data = yaml.load(fh, Loader=SafeLoader)
+
+    EXTENSION_MODULES_VALIDATOR.validate(data)
+
+    # Target triple patterns are matched for every extension on every build.
+    # Compile them once here instead.
+    for info in data.values():
+        for key in ("disabled-targets", "required-targets"):
+            if key in info:
+                info[key] = [re.compile(p) for p in info[key]]
+
+        for key in (
+            "defines-conditional",
+            "includes-conditional",
+            "links-conditional",
+            "linker-args",
+            "sources-conditional",
+        ):
+            for entry in info.get(key, []):
+                if "targets" in entry:
+                    entry["targets"] = [re.compile(p) for p in entry["targets"]]
 
     return data